@@ -2,28 +2,45 @@ import streamlit as st
 import pandas as pd
 import tempfile
 import os
+import functools
+import itertools
+import re
+import hashlib
+import importlib
+import multiprocessing
+import pickle
+import shutil
+import threading
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-import base64
-
-# Essayer d'importer les différentes librairies
-try:
-    import tabula
-    TABULA_AVAILABLE = True
-except ImportError:
-    TABULA_AVAILABLE = False
-
-try:
-    import fitz  # PyMuPDF
-    PYMUPDF_AVAILABLE = True
-except ImportError:
-    PYMUPDF_AVAILABLE = False
-
-try:
-    import pdfplumber
-    PDFPLUMBER_AVAILABLE = True
-except ImportError:
-    PDFPLUMBER_AVAILABLE = False
+
+# Librairies optionnelles : nom utilisé dans le code -> module à importer
+MODULES_OPTIONNELS = {
+    "tabula": "tabula",
+    "fitz": "fitz",  # PyMuPDF
+    "pdfplumber": "pdfplumber",
+    "pdfium": "pypdfium2",
+    "pdfium_c": "pypdfium2.raw",
+    "pa": "pyarrow",
+}
+
+@functools.lru_cache(maxsize=None)
+def _backend(nom):
+    """Importe la librairie optionnelle `nom` à sa première utilisation, None si elle est absente
+    
+    Seule la librairie demandée est importée. Le cache ne dure qu'une exécution du script,
+    que Streamlit relance à chaque interaction : les imports suivants sont servis par sys.modules.
+    """
+    try:
+        return importlib.import_module(MODULES_OPTIONNELS[nom])
+    except ImportError:
+        return None
+
+def _tabula_enabled():
+    """tabula lance une JVM à chaque appel : uniquement sur demande explicite (EXTRACT_TABULA=1)"""
+    return _backend("tabula") is not None and os.environ.get("EXTRACT_TABULA", "0") == "1"
 
 # Configuration de la page
 st.set_page_config(
@@ -32,55 +49,243 @@ st.set_page_config(
     layout="wide"
 )
 
-def process_pdf_with_pymupdf(tmp_file_path):
-    """Extrait les tableaux avec PyMuPDF (sans Java)"""
-    try:
-        doc = fitz.open(tmp_file_path)
-        resultats_intermediaires = []
-        total_tables = 0
-        
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            tables = page.find_tables()
+# Texte identifiant les tableaux de consommation recherchés, compilé une seule fois
+# (tolère la casse, les espaces multiples ou retours à la ligne et l'absence d'accent)
+MARQUEUR_CONSOMMATION_RE = re.compile(r"Consommation\s+totale\s+[ée]lectrique", re.IGNORECASE)
+
+# Au-delà de cette taille estimée, les CSV sont compressés dans le ZIP
+SEUIL_COMPRESSION_ZIP = 1024 * 1024
+
+# Nombre de pages traitées par tâche lors de l'extraction parallèle PyMuPDF
+PAGES_PAR_BLOC = 4
+
+# En dessous de ce nombre de pages contenant le marqueur, l'extraction PyMuPDF reste dans
+# le processus courant : démarrer des processus coûterait plus que les find_tables évités
+PAGES_MIN_PARALLELE = 8
+
+# Stratégies de détection des tableaux PyMuPDF essayées sur la première page pertinente,
+# en commençant par le défaut "lines"
+STRATEGIES_PYMUPDF = ("lines", "text")
+
+# Écart maximal (en points) pour considérer deux réglures comme superposées
+TOLERANCE_REGLURE = 2
+
+def _rows_have_marker(rows, marker=MARQUEUR_CONSOMMATION_RE):
+    """Indique si une cellule des lignes contient le marqueur (arrêt à la première trouvée)"""
+    for row in rows:
+        if any(cellule is not None and marker.search(str(cellule)) for cellule in row):
+            return True
+    return False
+
+def _table_has_marker(df, marker=MARQUEUR_CONSOMMATION_RE):
+    """Indique si l'en-tête ou une cellule du DataFrame contient le marqueur
+    
+    L'en-tête est testé comme une ligne, comme pour les tableaux bruts des autres méthodes.
+    """
+    return _rows_have_marker(itertools.chain([df.columns], df.itertuples(index=False, name=None)), marker)
+
+def _annule(annulation):
+    """Indique si l'extraction a été annulée (une méthode prioritaire a abouti)"""
+    return annulation is not None and annulation.is_set()
+
+def _get_max_workers():
+    """Nombre de processus utilisés pour l'extraction parallèle"""
+    return max(1, min(os.cpu_count() or 1, 6))
+
+def _ouvrir_pymupdf(source):
+    """Ouvre un document PyMuPDF depuis un chemin ou depuis le contenu du PDF en mémoire"""
+    fitz = _backend("fitz")
+    if isinstance(source, (str, os.PathLike)):
+        return fitz.open(source)
+    return fitz.open(stream=source, filetype="pdf")
+
+def _pages_marqueur_pymupdf(doc):
+    """Indices (à partir de 0) des pages dont le texte brut contient le marqueur"""
+    return [
+        page_num
+        for page_num, page in enumerate(doc)
+        if MARQUEUR_CONSOMMATION_RE.search(page.get_text("text"))
+    ]
+
+def _choisir_strategie_pymupdf(page):
+    """Choisit, sur la première page contenant le marqueur, la stratégie de tout le document
+    
+    Retourne (stratégie, tableaux trouvés sur cette page) pour ne pas refaire la détection :
+    "lines" (défaut de PyMuPDF), sauf s'il ne trouve aucun tableau et que "text" en trouve.
+    """
+    for strategie in STRATEGIES_PYMUPDF:
+        tables = page.find_tables(strategy=strategie).tables
+        if tables:
+            return strategie, tables
+    return STRATEGIES_PYMUPDF[0], []
+
+def _dataframe_pymupdf(table, lignes):
+    """Construit le DataFrame d'un tableau PyMuPDF à partir de ses lignes déjà extraites
+    
+    Mêmes noms de colonnes que Table.to_pandas, qui referait l'extraction des cellules.
+    """
+    noms = [nom if nom else f"Col{i}" for i, nom in enumerate(table.header.names)]
+    if len(set(noms)) != len(noms):
+        noms = [nom if nom == f"Col{i}" else f"{i}-{nom}" for i, nom in enumerate(noms)]
+    # En-tête intégré au tableau : c'est sa première ligne
+    if not table.header.external:
+        lignes = lignes[1:]
+    return pd.DataFrame(lignes, columns=noms)
+
+def _tables_avec_marqueur_pymupdf(page_num, tables):
+    """Convertit en DataFrame les tableaux d'une page qui contiennent le marqueur"""
+    resultats = []
+    for table in tables:
+        try:
+            # Test sur les cellules brutes (en-tête compris) : DataFrame créé uniquement si pertinent
+            lignes = table.extract()
+            if _rows_have_marker(itertools.chain([table.header.names], lignes)):
+                df = _dataframe_pymupdf(table, lignes)
+                # Marqueur seulement dans l'en-tête : tableau sans données ignoré
+                if not df.empty:
+                    resultats.append((page_num, df))
+        except Exception as e:
+            continue
+    return resultats
+
+def _extract_pages_pymupdf(doc, page_indices, strategie, annulation=None):
+    """Extrait les tableaux des pages indiquées, déjà filtrées sur le marqueur"""
+    resultats = []
+    total_tables = 0
+    
+    for page_num in page_indices:
+        if _annule(annulation):
+            break
+        page = doc[page_num]
+        try:
+            tables = page.find_tables(strategy=strategie).tables
             total_tables += len(tables)
+            resultats.extend(_tables_avec_marqueur_pymupdf(page_num, tables))
+            del tables
+        finally:
+            # Libérer la page et vider le cache MuPDF : mémoire stable sur les gros PDF
+            page = None
+            _backend("fitz").TOOLS.store_shrink(100)
+    
+    return resultats, total_tables
+
+# Source du PDF propre à chaque processus de travail, transmise une seule fois
+_source_worker = None
+
+def _init_worker_pymupdf(source):
+    """Mémorise la source du PDF dans le processus de travail"""
+    global _source_worker
+    _source_worker = source
+
+def _extract_bloc_worker(page_indices, strategie):
+    """Extrait un bloc de pages à partir de la source mémorisée par le processus"""
+    # Chaque processus ouvre son propre document : les objets fitz ne sont pas picklables
+    with _ouvrir_pymupdf(_source_worker) as doc:
+        return _extract_pages_pymupdf(doc, page_indices, strategie)
+
+def _extract_blocs_en_parallele(source, blocs, strategie, annulation=None):
+    """Répartit les blocs de pages sur un pool de processus"""
+    max_workers = min(_get_max_workers(), len(blocs))
+    # spawn plutôt que fork : forker le serveur Streamlit multi-thread peut bloquer
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker_pymupdf,
+        initargs=(source,)
+    ) as executor:
+        futures = [executor.submit(_extract_bloc_worker, bloc, strategie) for bloc in blocs]
+        resultats_blocs = []
+        for future in futures:
+            if _annule(annulation):
+                # Résultat devenu inutile : abandonner les blocs pas encore commencés
+                for restant in futures:
+                    restant.cancel()
+                break
+            resultats_blocs.append(future.result())
+        return resultats_blocs
+
+def process_pdf_with_pymupdf(source, annulation=None):
+    """Extrait les tableaux avec PyMuPDF (sans Java), pages réparties sur plusieurs processus
+    si elles sont nombreuses
+    
+    source : chemin du fichier ou contenu du PDF (bytes)
+    """
+    try:
+        with _ouvrir_pymupdf(source) as doc:
+            # Test rapide sur le texte brut, fait une seule fois ici : seules les pages
+            # contenant le marqueur passent par find_tables
+            pages_marqueur = _pages_marqueur_pymupdf(doc)
+            if not pages_marqueur:
+                return [], 0
+            
+            # Même stratégie pour toutes les pages, choisie sur la première page pertinente
+            # dont les tableaux déjà détectés sont conservés
+            premiere_page, pages_restantes = pages_marqueur[0], pages_marqueur[1:]
+            strategie, tables = _choisir_strategie_pymupdf(doc[premiere_page])
+            resultats_blocs = [(_tables_avec_marqueur_pymupdf(premiere_page, tables), len(tables))]
+            del tables
             
-            for table in tables:
+            resultats_restants = None
+            if len(pages_restantes) >= PAGES_MIN_PARALLELE:
+                # Regrouper les pages par blocs pour amortir le démarrage des processus et fitz.open
+                blocs = [
+                    pages_restantes[debut:debut + PAGES_PAR_BLOC]
+                    for debut in range(0, len(pages_restantes), PAGES_PAR_BLOC)
+                ]
                 try:
-                    df = table.to_pandas()
-                    if not df.empty:
-                        table_str = df.astype(str).apply(lambda x: ' '.join(x), axis=1).str.cat(sep=' ')
-                        if "Consommation totale électrique" in table_str:
-                            resultats_intermediaires.append((page_num, df))
-                except Exception as e:
-                    continue
+                    resultats_restants = _extract_blocs_en_parallele(source, blocs, strategie, annulation)
+                except (BrokenProcessPool, OSError, pickle.PicklingError):
+                    # Pool indisponible ou interrompu : extraction dans ce processus
+                    resultats_restants = None
+            if resultats_restants is None:
+                # Peu de pages pertinentes (le démarrage des processus coûterait plus cher)
+                # ou repli après échec du pool
+                resultats_restants = [_extract_pages_pymupdf(doc, pages_restantes, strategie, annulation)]
+            resultats_blocs.extend(resultats_restants)
         
-        doc.close()
+        resultats_intermediaires = []
+        total_tables = 0
+        for resultats, nb_tables in resultats_blocs:
+            resultats_intermediaires.extend(resultats)
+            total_tables += nb_tables
+        
+        # Conserver l'ordre des pages
+        resultats_intermediaires.sort(key=lambda resultat: resultat[0])
         return resultats_intermediaires, total_tables
     except Exception as e:
         raise Exception(f"Erreur PyMuPDF: {e}")
 
-def process_pdf_with_pdfplumber(tmp_file_path):
-    """Extrait les tableaux avec pdfplumber (sans Java)"""
+def process_pdf_with_pdfplumber(source, annulation=None):
+    """Extrait les tableaux avec pdfplumber (sans Java)
+    
+    source : chemin du fichier ou contenu du PDF (bytes)
+    """
+    pdfplumber = _backend("pdfplumber")
+    assert pdfplumber is not None
     try:
-        import pdfplumber
-        
         resultats_intermediaires = []
         total_tables = 0
         
-        with pdfplumber.open(tmp_file_path) as pdf:
+        if isinstance(source, (bytes, bytearray)):
+            source = BytesIO(source)
+        
+        with pdfplumber.open(source) as pdf:
             for page_num, page in enumerate(pdf.pages):
+                if _annule(annulation):
+                    break
+                # Test rapide sur le texte brut avant la détection des tableaux
+                # (sans dépendre de PyMuPDF, dont pdfplumber est le repli)
+                if not MARQUEUR_CONSOMMATION_RE.search(page.extract_text() or ""):
+                    continue
                 tables = page.extract_tables()
                 total_tables += len(tables)
                 
                 for table in tables:
-                    if table and len(table) > 1:
+                    if table and len(table) > 1 and _rows_have_marker(table):
                         try:
                             # Convertir en DataFrame
                             df = pd.DataFrame(table[1:], columns=table[0])
-                            table_str = df.astype(str).apply(lambda x: ' '.join(x), axis=1).str.cat(sep=' ')
-                            
-                            if "Consommation totale électrique" in table_str:
-                                resultats_intermediaires.append((page_num, df))
+                            resultats_intermediaires.append((page_num, df))
                         except Exception as e:
                             continue
         
@@ -88,12 +293,158 @@ def process_pdf_with_pdfplumber(tmp_file_path):
     except Exception as e:
         raise Exception(f"Erreur pdfplumber: {e}")
 
-def process_pdf_with_tabula(tmp_file_path):
+def _reglures_pdfium(page):
+    """Retourne les réglures verticales (x, bas, haut) et horizontales (y, gauche, droite) de la page"""
+    pdfium_c = _backend("pdfium_c")
+    verticales, horizontales = [], []
+    for obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_PATH,), max_depth=2):
+        left, bottom, right, top = obj.get_pos()
+        # Une réglure est un chemin très étroit dans un sens et plus long dans l'autre
+        if right - left <= TOLERANCE_REGLURE < top - bottom:
+            verticales.append(((left + right) / 2, bottom, top))
+        elif top - bottom <= TOLERANCE_REGLURE < right - left:
+            horizontales.append(((bottom + top) / 2, left, right))
+    return verticales, horizontales
+
+def _positions_distinctes(positions):
+    """Fusionne les positions quasi superposées (bordures doubles, traits répétés par cellule)"""
+    distinctes = []
+    for position in sorted(positions):
+        if not distinctes or position - distinctes[-1] > TOLERANCE_REGLURE:
+            distinctes.append(position)
+    return distinctes
+
+def _reglure_entre(reglures, position, debut, fin):
+    """Indique si une réglure passe à `position` au milieu du segment [debut, fin]"""
+    milieu = (debut + fin) / 2
+    return any(
+        abs(p - position) <= TOLERANCE_REGLURE
+        and a - TOLERANCE_REGLURE <= milieu <= b + TOLERANCE_REGLURE
+        for p, a, b in reglures
+    )
+
+def _texte_cellule_pdfium(textpage, left, bottom, right, top):
+    """Texte d'une cellule, une ligne par ligne de texte (comme PyMuPDF)"""
+    # PDFium signale une césure de fin de ligne par le caractère \x02
+    texte = textpage.get_text_bounded(left, bottom, right, top).replace("\x02", "-")
+    return "\n".join(ligne.strip() for ligne in texte.splitlines() if ligne.strip())
+
+def _tableaux_pdfium(textpage, page):
+    """Reconstruit les tableaux quadrillés d'une page à partir de ses réglures
+    
+    Chaque cellule est délimitée par les réglures ; une cellule fusionnée (réglure absente
+    entre deux cases voisines) est lue en une fois et son texte placé dans sa première case.
+    """
+    verticales, horizontales = _reglures_pdfium(page)
+    # Ordonnées des lignes, de haut en bas (l'axe y du PDF étant ascendant)
+    niveaux = _positions_distinctes(y for y, _, _ in horizontales)[::-1]
+    
+    # Deux niveaux consécutifs appartiennent au même tableau si une réglure verticale les relie
+    grilles = []
+    for haut, bas in zip(niveaux, niveaux[1:]):
+        if not any(a - TOLERANCE_REGLURE <= (haut + bas) / 2 <= b + TOLERANCE_REGLURE for _, a, b in verticales):
+            continue
+        if grilles and grilles[-1][-1] == haut:
+            grilles[-1].append(bas)
+        else:
+            grilles.append([haut, bas])
+    
+    tableaux = []
+    for ys in grilles:
+        xs = _positions_distinctes(
+            x for x, a, b in verticales
+            if a >= ys[-1] - TOLERANCE_REGLURE and b <= ys[0] + TOLERANCE_REGLURE
+        )
+        # Moins de deux réglures verticales : pas de tableau quadrillé
+        if len(xs) < 2:
+            continue
+        
+        nb_lignes, nb_colonnes = len(ys) - 1, len(xs) - 1
+        lignes = [[""] * nb_colonnes for _ in range(nb_lignes)]
+        couvertes = set()
+        for i in range(nb_lignes):
+            for j in range(nb_colonnes):
+                if (i, j) in couvertes:
+                    continue
+                # Étendre la cellule tant qu'aucune réglure ne la sépare de sa voisine
+                fin_j = j
+                while fin_j + 1 < nb_colonnes and not _reglure_entre(verticales, xs[fin_j + 1], ys[i + 1], ys[i]):
+                    fin_j += 1
+                fin_i = i
+                while fin_i + 1 < nb_lignes and not _reglure_entre(horizontales, ys[fin_i + 1], xs[j], xs[fin_j + 1]):
+                    fin_i += 1
+                couvertes.update((a, b) for a in range(i, fin_i + 1) for b in range(j, fin_j + 1))
+                lignes[i][j] = _texte_cellule_pdfium(textpage, xs[j], ys[fin_i + 1], xs[fin_j + 1], ys[i])
+        tableaux.append(lignes)
+    
+    return tableaux
+
+def process_pdf_with_pdfium(source, annulation=None):
+    """Extrait les tableaux quadrillés avec pypdfium2 (sans Java)
+    
+    source : chemin du fichier ou contenu du PDF (bytes)
+    """
+    pdfium = _backend("pdfium")
+    try:
+        pdf = pdfium.PdfDocument(source)
+        resultats_intermediaires = []
+        total_tables = 0
+        
+        try:
+            for page_num in range(len(pdf)):
+                if _annule(annulation):
+                    break
+                page = pdf[page_num]
+                textpage = page.get_textpage()
+                try:
+                    # Test rapide sur le texte brut avant toute reconstruction de tableau
+                    if not MARQUEUR_CONSOMMATION_RE.search(textpage.get_text_bounded()):
+                        continue
+                    
+                    for table in _tableaux_pdfium(textpage, page):
+                        if len(table) > 1:
+                            total_tables += 1
+                            if _rows_have_marker(table):
+                                df = pd.DataFrame(table[1:], columns=table[0])
+                                resultats_intermediaires.append((page_num, df))
+                finally:
+                    textpage.close()
+                    page.close()
+        finally:
+            pdf.close()
+        
+        return resultats_intermediaires, total_tables
+    except Exception as e:
+        raise Exception(f"Erreur pypdfium2: {e}")
+
+def _pages_avec_marqueur(source):
+    """Liste les numéros de page (à partir de 1) dont le texte contient le marqueur"""
+    with _ouvrir_pymupdf(source) as doc:
+        return [page_num + 1 for page_num in _pages_marqueur_pymupdf(doc)]
+
+def _pages_tabula(source):
+    """Pages à transmettre à tabula, pré-filtrées avec PyMuPDF pour limiter le travail de la JVM
+    
+    Retourne 'all' si le pré-filtrage est impossible, None si aucune page ne contient le marqueur.
+    """
+    if not _backend("fitz"):
+        return 'all'
+    try:
+        pages_trouvees = _pages_avec_marqueur(source)
+    except Exception:
+        # PyMuPDF ne sait pas lire ce PDF : tabula analyse toutes les pages
+        return 'all'
+    if not pages_trouvees:
+        return None
+    return ",".join(str(page) for page in pages_trouvees)
+
+def process_pdf_with_tabula(tmp_file_path, pages='all'):
     """Extrait les tableaux avec tabula (nécessite Java)"""
+    tabula = _backend("tabula")
     try:
         tables = tabula.read_pdf(
             tmp_file_path, 
-            pages='all', 
+            pages=pages, 
             multiple_tables=True, 
             lattice=True
         )
@@ -104,9 +455,7 @@ def process_pdf_with_tabula(tmp_file_path):
             if table.empty:
                 continue
             
-            table_str = table.astype(str).apply(lambda x: ' '.join(x), axis=1).str.cat(sep=' ')
-            
-            if "Consommation totale électrique" in table_str:
+            if _table_has_marker(table):
                 resultats_intermediaires.append((i, table))
         
         return resultats_intermediaires, len(tables)
@@ -115,160 +464,229 @@ def process_pdf_with_tabula(tmp_file_path):
 
 def sanitize_columns(df):
     """Nettoie les colonnes pour éviter les doublons ou noms vides"""
-    cols = []
-    seen = {}
-    for i, col in enumerate(df.columns):
-        if not col or pd.isna(col):
-            col = f"col_{i}"
-        if col in seen:
-            seen[col] += 1
-            col = f"{col}_{seen[col]}"
-        else:
-            seen[col] = 0
-        cols.append(col)
-    df.columns = cols
+    noms = pd.Series(df.columns, dtype=object)
+    # Noms vides ou manquants : remplacés par col_<position>
+    vides = noms.isna() | (noms.astype(str) == "")
+    noms = noms.astype(str).mask(vides, "col_" + pd.Series(range(len(noms))).astype(str))
+    # Doublons : la première occurrence garde son nom, les suivantes sont suffixées _1, _2...
+    rang = noms.groupby(noms).cumcount()
+    noms = noms.where(rang == 0, noms + "_" + rang.astype(str))
+    df.columns = noms.tolist()
     return df
 
+def to_arrow_dtypes(df):
+    """Convertit les colonnes de texte en chaînes PyArrow (plus compactes que les objets Python)
+    
+    Les colonnes numériques gardent leur type : convert_dtypes les retyperait et changerait
+    leur format dans le CSV (2.0 écrit 2).
+    """
+    if not _backend("pa"):
+        return df
+    colonnes = df.select_dtypes(include="object").columns
+    if colonnes.empty:
+        return df
+    return df.astype({colonne: "string[pyarrow]" for colonne in colonnes})
 
-def process_pdf(uploaded_file):
-    """Traite le PDF et extrait les tableaux de consommation"""
+def write_csv(df, buffer):
+    """Écrit le DataFrame en CSV
     
-    # Créer un fichier temporaire
+    L'écriture reste confiée à pandas : le writer PyArrow met tous les textes entre
+    guillemets et changerait le format des fichiers téléchargés.
+    """
+    df.to_csv(buffer, index=False, encoding='utf-8')
+
+
+def _write_tempfile(uploaded_file):
+    """Copie le PDF téléchargé dans un fichier temporaire et retourne son chemin"""
     with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        tmp_file_path = tmp_file.name
+        # Copie par blocs de 1 Mo : évite de dupliquer tout le PDF en mémoire
+        uploaded_file.seek(0)
+        shutil.copyfileobj(uploaded_file, tmp_file, length=1024 * 1024)
+        return tmp_file.name
+
+def _pdf_hash(uploaded_file):
+    """Empreinte du contenu du PDF, utilisée comme clé de cache"""
+    return hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+
+def _message_erreur(nom, erreur):
+    """Message affiché pour une méthode d'extraction en échec"""
+    if nom == "tabula":
+        return f"Tabula a échoué (Java requis): {erreur}"
+    return f"{nom} a échoué: {erreur}"
+
+def process_pdf(uploaded_file):
+    """Traite le PDF et extrait les tableaux de consommation (résultat mis en cache par contenu)"""
+    # Progress bar
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    
+    status_text.text("🔍 Extraction des tableaux...")
+    progress_bar.progress(25)
+    
+    pdf_hash = _pdf_hash(uploaded_file)
+    try:
+        csv_files, total_tables, method_used, erreurs = _extract(pdf_hash, uploaded_file)
+    except Exception as e:
+        # Aucune librairie installée : les exceptions ne sont pas mises en cache
+        st.error(f"❌ {e}")
+        show_installation_help()
+        return [], 0, 0
+    
+    if erreurs:
+        # Échec (peut-être passager) d'au moins une méthode : résultat retiré du cache
+        # pour que le prochain clic relance toutes les méthodes
+        _extract.clear(pdf_hash, uploaded_file)
+    
+    # Messages dans l'ordre de préférence des méthodes
+    for nom, erreur in erreurs:
+        if nom == "tabula":
+            st.error(_message_erreur(nom, erreur))
+        else:
+            st.warning(_message_erreur(nom, erreur))
+    
+    if not csv_files:
+        # Afficher les options d'installation
+        st.error("❌ Aucune méthode d'extraction n'a fonctionné")
+        show_installation_help()
+        return [], total_tables, 0
+    
+    st.info(f"✅ Extraction réussie avec {method_used}")
+    progress_bar.progress(100)
+    status_text.text(f"✅ Traitement terminé avec {method_used}!")
+    
+    return csv_files, total_tables, len(csv_files)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _extract(pdf_hash, _uploaded_file):
+    """Extrait les tableaux de consommation du PDF identifié par pdf_hash (sans affichage)
+    
+    Seul pdf_hash sert de clé de cache : _uploaded_file n'est pas haché par Streamlit.
+    Retourne (csv_files, total_tables, method_used, erreurs) ; un résultat accompagné
+    d'erreurs est retiré du cache par process_pdf.
+    """
+    
+    # Le fichier temporaire n'est créé que si une méthode nécessitant un chemin est utilisée
+    tmp_file_path = None
     
     try:
-        # Progress bar
-        progress_bar = st.progress(0)
-        status_text = st.empty()
-        
-        status_text.text("🔍 Lecture du PDF...")
-        progress_bar.progress(25)
-        
         # Essayer différentes méthodes d'extraction
         resultats_intermediaires = []
         total_tables = 0
         method_used = ""
         
-        # Méthode 1: PyMuPDF (sans Java)
-        if PYMUPDF_AVAILABLE:
-            try:
-                status_text.text("🔍 Extraction avec PyMuPDF...")
-                resultats_intermediaires, total_tables = process_pdf_with_pymupdf(tmp_file_path)
-                method_used = "PyMuPDF"
-                if resultats_intermediaires:
-                    st.info(f"✅ Extraction réussie avec {method_used}")
-            except Exception as e:
-                st.warning(f"PyMuPDF a échoué: {e}")
+        # Méthodes disponibles, par ordre de préférence
+        pdf_bytes = _uploaded_file.getvalue()
+        methodes = []
+        
+        # Méthodes 1 à 3 : PyMuPDF, pdfplumber et pypdfium2 (sans Java), directement depuis la mémoire
+        if _backend("fitz"):
+            methodes.append(("PyMuPDF", process_pdf_with_pymupdf))
+        if _backend("pdfplumber"):
+            methodes.append(("pdfplumber", process_pdf_with_pdfplumber))
+        if _backend("pdfium"):
+            methodes.append(("pypdfium2", process_pdf_with_pdfium))
         
-        # Méthode 2: pdfplumber (sans Java) si PyMuPDF n'a pas fonctionné
-        if not resultats_intermediaires and PDFPLUMBER_AVAILABLE:
+        tabula_enabled = _tabula_enabled()
+        if not methodes and not tabula_enabled:
+            raise Exception("Aucune librairie d'extraction PDF installée")
+        
+        # Lancer les méthodes sans Java en parallèle, mais retenir les résultats dans l'ordre de
+        # préférence : une méthode n'est retenue que si toutes les méthodes prioritaires ont
+        # terminé sans rien trouver. L'attente est celle de la plus lente, pas la somme des replis.
+        erreurs = []
+        if methodes:
+            annulation = threading.Event()
+            executor = ThreadPoolExecutor(max_workers=len(methodes))
             try:
-                status_text.text("🔍 Extraction avec pdfplumber...")
-                resultats_intermediaires, total_tables = process_pdf_with_pdfplumber(tmp_file_path)
-                method_used = "pdfplumber"
-                if resultats_intermediaires:
-                    st.info(f"✅ Extraction réussie avec {method_used}")
-            except Exception as e:
-                st.warning(f"pdfplumber a échoué: {e}")
+                futures = [
+                    (nom, executor.submit(fonction, pdf_bytes, annulation=annulation))
+                    for nom, fonction in methodes
+                ]
+                for nom, future in futures:
+                    try:
+                        resultats, nb_tables = future.result()
+                    except Exception as e:
+                        erreurs.append((nom, str(e)))
+                        continue
+                    total_tables = nb_tables
+                    if resultats:
+                        resultats_intermediaires = resultats
+                        method_used = nom
+                        break
+            finally:
+                # Sans attendre les méthodes restantes : elles s'arrêtent d'elles-mêmes à la page suivante
+                annulation.set()
+                executor.shutdown(wait=False, cancel_futures=True)
         
-        # Méthode 3: tabula (nécessite Java) en dernier recours
-        if not resultats_intermediaires and TABULA_AVAILABLE:
+        # Méthode 4: tabula (nécessite Java), si activé via EXTRACT_TABULA=1 ; lancée seulement
+        # si les autres méthodes n'ont rien trouvé, un appel à la JVM ne pouvant être interrompu
+        if not resultats_intermediaires and tabula_enabled:
             try:
-                status_text.text("🔍 Extraction avec tabula...")
-                resultats_intermediaires, total_tables = process_pdf_with_tabula(tmp_file_path)
-                method_used = "tabula"
-                if resultats_intermediaires:
-                    st.info(f"✅ Extraction réussie avec {method_used}")
+                # Les méthodes précédentes sont terminées : PyMuPDF est libre pour le pré-filtrage
+                pages = _pages_tabula(pdf_bytes)
+                # Aucune page ne contient le marqueur : inutile de lancer la JVM
+                if pages is not None:
+                    # Seule méthode qui lit le PDF depuis un fichier
+                    tmp_file_path = _write_tempfile(_uploaded_file)
+                    resultats, nb_tables = process_pdf_with_tabula(tmp_file_path, pages)
+                    total_tables = nb_tables
+                    if resultats:
+                        resultats_intermediaires = resultats
+                        method_used = "tabula"
             except Exception as e:
-                st.error(f"Tabula a échoué (Java requis): {e}")
-        
-        if not resultats_intermediaires:
-            # Afficher les options d'installation
-            st.error("❌ Aucune méthode d'extraction n'a fonctionné")
-            show_installation_help()
-            return [], total_tables, 0
-        
-        status_text.text("📊 Analyse des tableaux...")
-        progress_bar.progress(50)
-        
-        status_text.text("💾 Préparation des fichiers...")
-        progress_bar.progress(75)
+                erreurs.append(("tabula", str(e)))
         
         # Créer les fichiers CSV
         csv_files = []
         
-        if resultats_intermediaires:
-            # Créer un fichier pour chaque tableau trouvé
-            for idx, (table_num, df) in enumerate(resultats_intermediaires, start=1):
-                csv_buffer = BytesIO()
-                df = sanitize_columns(df)
-                df.to_csv(csv_buffer, index=False, encoding='utf-8')
-                csv_buffer.seek(0)
-                
-                csv_files.append({
-                    'name': f"consommation_tableau_{idx}.csv",
-                    'data': csv_buffer.getvalue(),
-                    'dataframe': df
-                })
+        # Créer un fichier pour chaque tableau trouvé
+        # (le CSV lui-même n'est produit qu'au téléchargement)
+        for idx, (table_num, df) in enumerate(resultats_intermediaires, start=1):
+            df = to_arrow_dtypes(sanitize_columns(df))
             
-            # Créer un fichier combiné si plusieurs tableaux
-            if len(resultats_intermediaires) > 1:
-                try:
-                    fusionne = pd.concat([df for _, df in resultats_intermediaires], ignore_index=True)
-                    csv_buffer_combined = BytesIO()
-                    fusionne.to_csv(csv_buffer_combined, index=False, encoding='utf-8')
-                    csv_buffer_combined.seek(0)
-                    
-                    csv_files.append({
-                        'name': "consommation_combine.csv",
-                        'data': csv_buffer_combined.getvalue(),
-                        'dataframe': fusionne
-                    })
-                except Exception as e:
-                    st.warning(f"Impossible de combiner les tableaux: {e}")
-        
-        progress_bar.progress(100)
-        status_text.text(f"✅ Traitement terminé avec {method_used}!")
+            csv_files.append({
+                'name': f"consommation_tableau_{idx}.csv",
+                'dataframe': df
+            })
         
-        return csv_files, total_tables, len(resultats_intermediaires)
-        
-    except Exception as e:
-        st.error(f"Erreur lors du traitement: {e}")
-        show_installation_help()
-        return [], 0, 0
+        return csv_files, total_tables, method_used, erreurs
     
     finally:
         # Nettoyer le fichier temporaire
-        try:
-            os.unlink(tmp_file_path)
-        except:
-            pass
+        if tmp_file_path:
+            try:
+                os.unlink(tmp_file_path)
+            except:
+                pass
 
 def show_installation_help():
     """Affiche l'aide pour l'installation des dépendances"""
     st.markdown("### 🔧 Installation des dépendances")
     
     st.markdown("**Option 1 - Sans Java (Recommandé) :**")
-    st.code("pip install PyMuPDF pdfplumber pandas")
+    st.code("pip install PyMuPDF pdfplumber pypdfium2 pandas")
     
     st.markdown("**Option 2 - Avec Java :**")
     st.code("pip install tabula-py pandas")
-    st.markdown("Puis installer Java depuis https://adoptium.net/")
+    st.markdown("Puis installer Java depuis https://adoptium.net/ et définir `EXTRACT_TABULA=1`")
     
     available_methods = []
-    if PYMUPDF_AVAILABLE:
+    if _backend("fitz"):
         available_methods.append("✅ PyMuPDF")
     else:
         available_methods.append("❌ PyMuPDF")
     
-    if PDFPLUMBER_AVAILABLE:
+    if _backend("pdfplumber"):
         available_methods.append("✅ pdfplumber")
     else:
         available_methods.append("❌ pdfplumber")
     
-    if TABULA_AVAILABLE:
+    if _backend("pdfium"):
+        available_methods.append("✅ pypdfium2")
+    else:
+        available_methods.append("❌ pypdfium2")
+    
+    if _tabula_enabled():
         available_methods.append("✅ tabula")
     else:
         available_methods.append("❌ tabula")
@@ -277,13 +695,56 @@ def show_installation_help():
     for method in available_methods:
         st.markdown(f"- {method}")
 
-def create_download_zip(csv_files):
-    """Crée un fichier ZIP contenant tous les CSV"""
+def _to_csv_bytes(df):
+    """Produit le contenu CSV d'un DataFrame au moment du téléchargement"""
+    csv_buffer = BytesIO()
+    write_csv(df, csv_buffer)
+    return csv_buffer.getvalue()
+
+def _combined_csv_bytes(frames, contenus):
+    """Assemble le CSV combiné à partir des CSV déjà produits pour chaque tableau
+    
+    Possible uniquement si tous les tableaux ont les mêmes colonnes et les mêmes types
+    (sinon pd.concat changerait le format de certaines valeurs, 2 devenant 2.0 par exemple) :
+    l'en-tête du premier est conservé, puis seuls les corps des suivants sont ajoutés.
+    Retourne None sinon.
+    """
+    colonnes, types = tuple(frames[0].columns), tuple(frames[0].dtypes)
+    if any(tuple(df.columns) != colonnes or tuple(df.dtypes) != types for df in frames[1:]):
+        return None
+    
+    morceaux = [contenus[0]]
+    for df, contenu in zip(frames[1:], contenus[1:]):
+        # L'en-tête peut contenir des retours à la ligne : on mesure sa longueur réelle
+        entete = _to_csv_bytes(df.iloc[:0])
+        if not contenu.startswith(entete):
+            return None
+        morceaux.append(contenu[len(entete):])
+    return b"".join(morceaux)
+
+def _fichier_combine(frames, contenus):
+    """Tableau combiné, affiché dans l'aperçu, et son CSV"""
+    fusionne = to_arrow_dtypes(pd.concat(frames, ignore_index=True, copy=False, sort=False))
+    data = _combined_csv_bytes(frames, contenus)
+    if data is None:
+        # Colonnes ou types différents : encodage du tableau concaténé
+        data = _to_csv_bytes(fusionne)
+    return fusionne, data
+
+def create_download_zip(csv_files, contenus):
+    """Crée un fichier ZIP contenant tous les CSV, à partir de leur contenu déjà produit"""
     zip_buffer = BytesIO()
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for csv_file in csv_files:
-            zip_file.writestr(csv_file['name'], csv_file['data'])
+    # Petits fichiers : stockage sans compression, plus rapide pour un gain de taille négligeable
+    # Gros fichiers : niveau 1, bien plus rapide que le niveau par défaut pour une taille proche
+    if sum(len(contenu) for contenu in contenus) > SEUIL_COMPRESSION_ZIP:
+        compression, compresslevel = zipfile.ZIP_DEFLATED, 1
+    else:
+        compression, compresslevel = zipfile.ZIP_STORED, None
+    
+    with zipfile.ZipFile(zip_buffer, 'w', compression, compresslevel=compresslevel) as zip_file:
+        for csv_file, contenu in zip(csv_files, contenus):
+            zip_file.writestr(csv_file['name'], contenu)
     
     zip_buffer.seek(0)
     return zip_buffer.getvalue()
@@ -331,12 +792,32 @@ def main():
             with st.spinner("Traitement en cours..."):
                 csv_files, total_tables, found_tables = process_pdf(uploaded_file)
             
+            # Contenu CSV de chaque tableau, produit une seule fois pour cet affichage
+            contenus = [_to_csv_bytes(csv_file['dataframe']) for csv_file in csv_files]
+            
+            # Fichier combiné si plusieurs tableaux (affiché dans l'aperçu, donc construit ici)
+            if len(csv_files) > 1:
+                try:
+                    fusionne, combine = _fichier_combine(
+                        [csv_file['dataframe'] for csv_file in csv_files],
+                        contenus
+                    )
+                    csv_files = csv_files + [{'name': "consommation_combine.csv", 'dataframe': fusionne}]
+                    contenus = contenus + [combine]
+                except Exception as e:
+                    st.warning(f"Impossible de combiner les tableaux: {e}")
+            
             # Affichage des résultats
             st.markdown("### 📊 Résultats du traitement")
             
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("📊 Tableaux totaux", total_tables)
+                # Seules les pages contenant le marqueur sont analysées
+                st.metric(
+                    "📊 Tableaux sur les pages analysées",
+                    total_tables,
+                    help="Tableaux détectés sur les pages contenant « Consommation totale électrique »"
+                )
             with col2:
                 st.metric("🎯 Tableaux de consommation", found_tables)
             with col3:
@@ -364,7 +845,7 @@ def main():
                     with cols[i % 3]:
                         st.download_button(
                             label=f"⬇️ {csv_file['name']}",
-                            data=csv_file['data'],
+                            data=contenus[i],
                             file_name=csv_file['name'],
                             mime='text/csv',
                             use_container_width=True
@@ -373,7 +854,7 @@ def main():
                 # Téléchargement groupé si plusieurs fichiers
                 if len(csv_files) > 1:
                     st.markdown("#### 📦 Téléchargement groupé")
-                    zip_data = create_download_zip(csv_files)
+                    zip_data = create_download_zip(csv_files, contenus)
                     
                     st.download_button(
                         label="⬇️ Télécharger tous les fichiers (ZIP)",
@@ -413,28 +894,31 @@ def main():
         
         st.markdown("### 🔧 Dépendances requises")
         
-        if not PYMUPDF_AVAILABLE and not PDFPLUMBER_AVAILABLE:
+        tabula_enabled = _tabula_enabled()
+        
+        if not _backend("fitz") and not _backend("pdfplumber") and not _backend("pdfium"):
             st.error("❌ Aucune librairie d'extraction PDF installée!")
-            st.code("pip install PyMuPDF pdfplumber")
+            st.code("pip install PyMuPDF pdfplumber pypdfium2")
         else:
             st.success("✅ Au moins une librairie d'extraction disponible")
         
         st.markdown("**Méthodes d'extraction :**")
         methods_status = [
-            ("PyMuPDF", PYMUPDF_AVAILABLE, "Sans Java, rapide"),
-            ("pdfplumber", PDFPLUMBER_AVAILABLE, "Sans Java, précis"),
-            ("tabula", TABULA_AVAILABLE, "Nécessite Java")
+            ("PyMuPDF", _backend("fitz") is not None, "Sans Java, rapide"),
+            ("pdfplumber", _backend("pdfplumber") is not None, "Sans Java, précis"),
+            ("pypdfium2", _backend("pdfium") is not None, "Sans Java, tableaux quadrillés"),
+            ("tabula", tabula_enabled, "Nécessite Java et EXTRACT_TABULA=1")
         ]
         
         for name, available, description in methods_status:
             status = "✅" if available else "❌"
             st.markdown(f"- {status} **{name}** : {description}")
         
-        if not any([PYMUPDF_AVAILABLE, PDFPLUMBER_AVAILABLE, TABULA_AVAILABLE]):
+        if not any([_backend("fitz"), _backend("pdfplumber"), _backend("pdfium"), tabula_enabled]):
             st.warning("🚨 Installez au moins une librairie pour continuer")
             st.code("""
 # Installation recommandée (sans Java)
-pip install PyMuPDF pdfplumber pandas
+pip install PyMuPDF pdfplumber pypdfium2 pandas
 
 # Ou avec Java
 pip install tabula-py pandas